@@ -1,9 +1,20 @@
-from typing import List, Optional, Callable, Tuple
+from typing import List, Optional, Callable, Tuple, Iterator, Dict
 import s3fs
 import os
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
 from dataclasses import dataclass
 import shutil
+import asyncio
+import functools
+import io
+import bisect
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ObjectStoreException(Exception):
@@ -21,8 +32,19 @@ class S3Query(ListQuery):
     recursive: Optional[bool] = None
 
 
+_DEFAULT_CONCURRENCY = 32
+
+
 # Interface
 class ObjectStore:
+    __slots__ = ('_concurrency',)
+
+    def __init__(self, concurrency: int = _DEFAULT_CONCURRENCY):
+        """
+        :param concurrency: max number of worker threads used by bulk operations such as exists_list
+        """
+        self._concurrency = concurrency
+
     def get_object(self, path: str) -> bytes:
         raise NotImplementedError
 
@@ -42,7 +64,26 @@ class ObjectStore:
         raise NotImplementedError
 
     def exists_list(self, paths: List[str]) -> List[str]:
-        return [p for p in paths if self.exists(p)]  # may be overriden for more efficient implementations
+        # may be overriden for more efficient implementations
+        if len(paths) <= 1:
+            return [p for p in paths if self.exists(p)]
+        # subclasses written before the concurrency setting may not call super().__init__()
+        concurrency = getattr(self, '_concurrency', _DEFAULT_CONCURRENCY)
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(paths))) as ex:
+            mask = list(ex.map(self.exists, paths))
+        return [p for p, m in zip(paths, mask) if m]
+
+    async def aget_object(self, path: str) -> bytes:
+        """
+        Async variant of get_object. Runs get_object on the default executor unless overriden
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_object, path)
+
+    async def aexists_list(self, paths: List[str]) -> List[str]:
+        """
+        Async variant of exists_list. Runs exists_list on the default executor unless overriden
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.exists_list, paths)
 
     def open(self, file, mode='r', **kwargs):
         raise NotImplementedError
@@ -51,115 +92,470 @@ class ObjectStore:
         raise NotImplementedError
 
 
+_S3_PREFIX = "s3://"
+_S3_PREFIX_LEN = len(_S3_PREFIX)
+
+# objects are downloaded as byte range GETs of this size, all but the first one in parallel
+_GET_CHUNK_SIZE = 8 * 1024 * 1024
+
+# objects larger than this are uploaded as multipart uploads of _PUT_CHUNK_SIZE bytes each
+_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+_PUT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# exists_list gives up on listing a prefix once it returns more than this many keys per requested path
+_EXISTS_LIST_MAX_KEYS_PER_PATH = 10
+
+
+def _slash_join(p: str, *paths) -> str:
+    """
+    Adds "/" if necessary between path elements
+    """
+    parts = [s for s in (p,) + paths if s != ""]
+    if not parts:
+        return ""
+    return "".join([s if s.endswith("/") else s + "/" for s in parts[:-1]]) + parts[-1]
+
+
+class _TTLCache:
+    """
+    Minimal thread safe LRU cache whose entries expire ttl seconds after being set.
+    Keys are tuples whose first element is the path the value depends on, so that entries can be dropped per path.
+    """
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expiry time, value)
+        self._keys_per_path = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple):
+        """
+        :return: the cached value, or None if missing or expired
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: Tuple, value, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            self._keys_per_path[key[0]].add(key)
+            if len(self._data) > self._maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, paths: List[str]) -> None:
+        with self._lock:
+            for path in paths:
+                for key in self._keys_per_path.pop(path, ()):
+                    del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._keys_per_path.clear()
+
+    def _remove(self, key: Tuple) -> None:
+        del self._data[key]
+        keys = self._keys_per_path[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_per_path[key[0]]
+
+
+class _OnCloseFile:
+    """
+    Proxy to a file object that calls on_close after the file is closed
+    """
+    def __init__(self, fp, on_close: Callable[[], None]):
+        self._fp = fp
+        self._on_close = on_close
+
+    def close(self) -> None:
+        try:
+            self._fp.close()
+        finally:
+            self._on_close()
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def __enter__(self) -> '_OnCloseFile':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __iter__(self):
+        return iter(self._fp)
+
+
+# exists / ls results, shared by all S3ObjectStore instances like the clients so that a write through any of them
+# invalidates what the others cached
+_S3_METADATA_CACHE = _TTLCache(maxsize=4096)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_s3_clients(max_pool_connections: int) -> Tuple[object, s3fs.S3FileSystem]:
+    """
+    Clients are shared by all S3ObjectStore instances (and worker threads, boto3 low level clients are thread safe)
+    to avoid paying credential resolution and TLS handshakes for each new store
+    """
+    s3 = boto3.client('s3', config=Config(
+        max_pool_connections=max_pool_connections,
+        retries={'max_attempts': 10, 'mode': 'adaptive'}
+    ))
+    s3_fs = s3fs.S3FileSystem(config_kwargs={'max_pool_connections': max_pool_connections})
+    return s3, s3_fs
+
+
 class S3ObjectStore(ObjectStore):
-    def __init__(self):
-        self._s3 = boto3.client('s3')
-        self._s3fs = s3fs.S3FileSystem()
+    def __init__(self, concurrency: int = 32, max_pool_connections: int = 64, cache_ttl: float = 5):
+        """
+        :param max_pool_connections: size of the HTTP connection pool, should be >= concurrency
+        :param cache_ttl: seconds during which results of exists and ls are cached, 0 disables caching.
+            Writes made through any S3ObjectStore invalidate the affected entries, writes made by other processes may be
+            missed until the entries expire.
+        """
+        super().__init__(concurrency)
+        self._s3, self._s3fs = _get_s3_clients(max_pool_connections)
+        self._cache_ttl = cache_ttl
+        self._transfer_config = TransferConfig(
+            multipart_threshold=_MULTIPART_THRESHOLD,
+            multipart_chunksize=_PUT_CHUNK_SIZE,
+            max_concurrency=min(concurrency, max_pool_connections),
+            use_threads=True
+        )
 
     def exists(self, path: str) -> bool:
-        return self._s3fs.exists(path)
+        return self._cached((path.rstrip("/"), "exists", path), lambda: self._s3fs.exists(path))
+
+    def exists_list(self, paths: List[str]) -> List[str]:
+        """
+        Lists each bucket once under the common prefix of the requested keys instead of issuing one HEAD per path.
+        Falls back to parallel HEAD requests when the common prefix matches too many unrelated keys.
+        """
+        keys_per_bucket = defaultdict(list)
+        for p in paths:
+            bucket, key = self._split_path(p)
+            keys_per_bucket[bucket].append(key)
+
+        existing = set()
+        head_paths = []
+        for bucket, keys in keys_per_bucket.items():
+            listed = None
+            common_prefix = os.path.commonprefix(keys)
+            # without a shared directory the listing would likely cover most of the bucket
+            if len(keys) > 1 and "/" in common_prefix:
+                max_keys = max(1000, _EXISTS_LIST_MAX_KEYS_PER_PATH * len(keys))
+                listed = self._list_keys(bucket, common_prefix, max_keys)
+            if listed is None:
+                head_paths += [_S3_PREFIX + bucket + "/" + k for k in keys]
+                continue
+
+            listed_set = set(listed)
+            for key in keys:
+                # a key also exists if it is a "directory" of some listed key, to match s3fs.exists
+                dir_prefix = key if key.endswith("/") else key + "/"
+                i = bisect.bisect_left(listed, dir_prefix)
+                if key in listed_set or (i < len(listed) and listed[i].startswith(dir_prefix)):
+                    existing.add(_S3_PREFIX + bucket + "/" + key)
+
+        existing.update(super().exists_list(head_paths))
+        return [p for p in paths if self._normalize_path(p) in existing]
+
+    async def aexists_list(self, paths: List[str]) -> List[str]:
+        async def exists_all():
+            # created here as it must belong to the s3fs loop
+            semaphore = asyncio.Semaphore(self._concurrency)
+
+            async def exists(p: str) -> bool:
+                async with semaphore:
+                    return await self._s3fs._exists(p)
+            return await asyncio.gather(*(exists(p) for p in paths))
+        mask = await self._on_s3fs_loop(exists_all())
+        return [p for p, m in zip(paths, mask) if m]
+
+    async def aget_object(self, path: str) -> bytes:
+        return await self._on_s3fs_loop(self._s3fs._cat_file(path))
+
+    def _on_s3fs_loop(self, coro) -> asyncio.Future:
+        """
+        Schedules coro on the event loop owned by s3fs (its aiobotocore session is bound to it)
+        and returns a future that can be awaited from the caller's loop
+        """
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._s3fs.loop))
+
+    def _list_keys(self, bucket: str, prefix: str, max_keys: int) -> Optional[List[str]]:
+        """
+        Returns all keys under prefix in lexicographic order, or None if there are more than max_keys of them
+        """
+        keys = []
+        paginator = self._s3.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000})
+        for key in pages.search("Contents[].Key"):
+            if key is None:  # page without Contents
+                continue
+            keys.append(key)
+            if len(keys) > max_keys:
+                return None
+        return keys
 
     def get_object(self, path: str) -> bytes:
-        with self.open(path, 'rb') as fp:
-            return fp.read()
+        """
+        The first _GET_CHUNK_SIZE bytes are fetched with a range GET, which also tells the object size.
+        The rest of larger objects is downloaded as concurrent range GETs, since a single stream is capped by
+        per connection bandwidth
+        """
+        bucket, key = self._split_path(path)
+        try:
+            rsp = self._s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{_GET_CHUNK_SIZE - 1}")
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(path) from e
+            if code == 'InvalidRange':  # empty objects can't be ranged
+                return self._s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+            raise
+        first = rsp['Body'].read()
+        # e.g. "bytes 0-8388607/20971520", absent if the whole object was returned
+        size = int(rsp['ContentRange'].rsplit("/", 1)[1]) if 'ContentRange' in rsp else len(first)
+        if size <= len(first):
+            return first
+
+        etag = rsp['ETag']
+
+        def get_range(start: int) -> Tuple[int, bytes]:
+            end = min(start + _GET_CHUNK_SIZE, size) - 1
+            # IfMatch fails the request if the object was overwritten since the first GET
+            rsp = self._s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)
+            return start, rsp['Body'].read()
+
+        buf = bytearray(size)
+        buf[:len(first)] = first
+        starts = range(len(first), size, _GET_CHUNK_SIZE)
+        with ThreadPoolExecutor(max_workers=min(self._concurrency, len(starts))) as ex:
+            for start, chunk in ex.map(get_range, starts):
+                buf[start:start + len(chunk)] = chunk
+        return bytes(buf)
 
     def put_object(self, path: str, data: bytes) -> None:
-        with self.open(path, 'wb') as fp:
-            fp.write(data)
+        """
+        Large objects are uploaded as a multipart upload with parts sent concurrently
+        """
+        bucket, key = self._split_path(path)
+        self._s3.upload_fileobj(io.BytesIO(data), bucket, key, Config=self._transfer_config)
+        self._invalidate(path)
 
     def ls(self, path: str, query: ListQuery = None) -> List[str]:
         if query is None:
-            return sorted(["s3://" + f for f in self._s3fs.ls(path)])
+            # s3fs lists directories after files, so this still needs sorting
+            files = self._cached(
+                (path.rstrip("/"), "ls", path),
+                lambda: sorted([_S3_PREFIX + f for f in self._s3fs.ls(path)])
+            )
         else:
-            return sorted(self._ls_query())
+            prefix, recursive = query.prefix or "", bool(query.recursive)
+            files = self._cached(
+                (self._listed_dir(path, prefix), "ls", path, prefix, recursive),
+                lambda: self._ls_query(path, prefix, recursive)
+            )
+        return list(files)  # copy, so that callers can't modify the cached list
+
+    def _listed_dir(self, path: str, prefix: str) -> str:
+        """
+        Directory containing every key listed by _ls_query(path, prefix), i.e. the directory of path + prefix
+        """
+        bucket, key_prefix = self._split_path(path)
+        key_prefix += prefix
+        i = key_prefix.rfind("/")
+        return _S3_PREFIX + bucket + ("/" + key_prefix[:i] if i >= 0 else "")
+
+    def _cached(self, key: Tuple, fn: Callable):
+        """
+        key[0] must be the path without trailing "/" of the object or directory the result depends on,
+        so that writes under it can invalidate it
+        """
+        if self._cache_ttl <= 0:
+            return fn()
+        result = _S3_METADATA_CACHE.get(key)
+        if result is None:
+            result = fn()
+            _S3_METADATA_CACHE.set(key, result, self._cache_ttl)
+        return result
+
+    def _invalidate(self, path: str, recursive: bool = False) -> None:
+        """
+        Drops cached results for path and its parent directories, or everything if recursive as any path under it
+        may be affected
+        """
+        self._s3fs.invalidate_cache(path)  # writes through boto3 bypass the s3fs listing cache
+        if recursive:
+            _S3_METADATA_CACHE.clear()
+            return
+        paths = [path.rstrip("/")]
+        while paths[-1].rfind("/") >= _S3_PREFIX_LEN:
+            paths.append(paths[-1][:paths[-1].rfind("/")])
+        _S3_METADATA_CACHE.invalidate(paths)
 
     def _ls_query(self, path: str, prefix: str, recursive: bool=False) -> List[str]:
         bucket, path_key = self._split_path(path)
         delim = "/" if not recursive else ""
         actual_prefix = path_key + prefix
 
-        rsp = self._s3.list_objects_v2(
-            Bucket=bucket,
-            Delimiter=delim,
-            Prefix=actual_prefix
-        )
-        if rsp['IsTruncated']:
-            raise AssertionError("Truncated responses not supported yet")
-
         files = []
-        if 'Contents' in rsp:
-            files += [o['Key'] for o in rsp['Contents']]
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Delimiter=delim, Prefix=actual_prefix,
+                                       PaginationConfig={'PageSize': 1000}):
+            if 'Contents' in page:
+                files += [o['Key'] for o in page['Contents']]
 
-        if 'CommonPrefixes' in rsp:
-            files += [o['Prefix'] for o in rsp['CommonPrefixes']]
+            if 'CommonPrefixes' in page:
+                files += [o['Prefix'] for o in page['CommonPrefixes']]
 
         # remove trailing "/" to match output of s3fs
         files = [f[:-1] if f.endswith("/") else f for f in files]
+        # S3 key order isn't kept once the trailing "/" are removed (e.g. "a-b" < "a/" but "a" < "a-b").
+        # The input is nearly sorted so this is close to linear
+        files.sort()
 
-        return ["s3://" + bucket + "/" + f for f in files]
+        return [_S3_PREFIX + bucket + "/" + f for f in files]
 
     def rm(self, path: str, recursive=False) -> None:
         self._s3fs.rm(path, recursive=recursive)
+        self._invalidate(path, recursive)
 
     def open(self, file, mode="r", **kwargs):
-        return self._s3fs.open(file, mode, **kwargs)
+        fp = self._s3fs.open(file, mode, **kwargs)
+        if "r" in mode:
+            return fp
+        # the object is only written on close, anything cached while the file is open would be stale after
+        self._invalidate(file)
+        return _OnCloseFile(fp, lambda: self._invalidate(file))
 
     def path_join(self, p: str, *paths) -> str:
-        """
-        Adds "/" if necessary between path elements
-        """
-        all_paths = [p] + list(paths)
-        all_paths = [p for p in all_paths if p != ""]
-        for i in range(len(all_paths)-1):
-            if not all_paths[i].endswith("/"):
-                all_paths[i] += "/"
-        return "".join(all_paths)
+        return _slash_join(p, *paths)
+
+    def _normalize_path(self, path: str) -> str:
+        bucket, key = self._split_path(path)
+        return _S3_PREFIX + bucket + "/" + key
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8192)
+    def _split_path(path: str) -> Tuple[str, str]:
+        if not path.startswith(_S3_PREFIX):
+            raise ObjectStoreException(f"Not an S3 path: {path}")
+        i = path.find("/", _S3_PREFIX_LEN)
+        if i < 0:
+            return path[_S3_PREFIX_LEN:], ""
+        return path[_S3_PREFIX_LEN:i], path[i+1:]
 
-    def _split_path(self, path: str) -> Tuple[str, str]:
-        assert(path.startswith("s3://"))
-        parts = path[5:].split("/")
-        bucket_name = parts[0]
-        key = "/".join(parts[1:]) if len(parts) > 1 else ""
-        return bucket_name, key
+
+# flag needed on Windows to avoid newline translation with os.open, 0 elsewhere
+_O_BINARY = getattr(os, 'O_BINARY', 0)
+_LOCAL_READ_CHUNK_SIZE = 1024 * 1024
 
 
 class LocalObjectStore(ObjectStore):
-    def __init__(self):
-        pass
+    def __init__(self, concurrency: int = 32):
+        super().__init__(concurrency)
 
     def exists(self, path: str) -> bool:
         return os.path.exists(path)
 
+    def exists_list(self, paths: List[str]) -> List[str]:
+        """
+        A stat per path is cheaper than reading the parent directories or dispatching to worker threads
+        """
+        return [p for p in paths if os.path.exists(p)]
+
     def get_object(self, path: str) -> bytes:
-        with self.open(path, 'rb') as fp:
-            return fp.read()
+        """
+            Reads with unbuffered os.read calls sized to the file, skipping the copy through a BufferedReader
+        """
+        fd = os.open(path, os.O_RDONLY | _O_BINARY)
+        try:
+            size = os.fstat(fd).st_size
+            chunks = [os.read(fd, size)] if size > 0 else []
+            # keep reading until EOF, in case of short reads or files whose size isn't reported (e.g. /proc)
+            while True:
+                chunk = os.read(fd, _LOCAL_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
 
     def put_object(self, path: str, data: bytes) -> None:
         """
             Creates directory if it doesn't exist
         """
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with self.open(path, 'wb') as fp:
-            fp.write(data)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o666)
+        try:
+            view = memoryview(data)
+            written = 0
+            while written < len(view):
+                written += os.write(fd, view[written:])
+        finally:
+            os.close(fd)
 
     def ls(self, path: str, query: ListQuery =None) -> List[str]:
         if query is None:
-            return sorted([self.path_join(path, f) for f in os.listdir(path)])
+            # sort the bare names, they all share the same parent so the order is the same once joined
+            names = os.listdir(path)
+            names.sort()
+            return [self.path_join(path, f) for f in names]
         else:
-            return sorted(self._ls_query(query))
+            return self._ls_query(path, query.prefix or "", bool(query.recursive))
 
     def _ls_query(self, path: str, prefix: str, recursive: bool=False) -> List[str]:
+        """
+        Like S3, lists the paths starting with path + prefix (plain concatenation, so "d" and "x" match "dx...").
+        Unless recursive, only the entries of the directory containing path + prefix are listed.
+        """
+        full_prefix = path + prefix
+        parent = os.path.dirname(full_prefix)
         if recursive:
-            all_files = []
-            for sub_path, subdirs, files in os.walk(path):
-                for name in files:
-                    all_files.append(os.path.join(sub_path, name))
+            if parent == "":
+                parent, full_prefix = os.curdir, os.path.join(os.curdir, full_prefix)
+            all_files = self._walk_files(parent)
         else:
-            all_files = self.ls(path)
-        files = [f for f in all_files if f.startswith(prefix)]
+            try:
+                all_files = [os.path.join(parent, f) for f in os.listdir(parent or os.curdir)]
+            except (FileNotFoundError, NotADirectoryError):
+                all_files = []
+        files = [f for f in all_files if f.startswith(full_prefix)]
         files.sort()
         return files
 
+    def _walk_files(self, path: str) -> Iterator[str]:
+        """
+        Recursively yields all file paths under path. scandir reuses the file type returned by readdir,
+        so unlike os.walk no extra stat call is needed per entry.
+        Like os.walk, missing or unreadable directories are skipped and symlinks to directories aren't followed
+        """
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                yield entry.path
+            elif not entry.is_symlink():
+                yield from self._walk_files(entry.path)
+
     def rm(self, path: str, recursive=False) -> None:
         if recursive:
             if len(path) < 5:
@@ -182,8 +578,10 @@ class LocalObjectStore(ObjectStore):
 
 
 class MultiObjectStore(ObjectStore):
-    def __init__(self):
+    def __init__(self, concurrency: int = 32):
+        super().__init__(concurrency)
         self.map_prefix_fs = {}
+        self._sorted_prefixes: List[Tuple[str, ObjectStore]] = []
 
     def add_fs(self, fs: ObjectStore, prefix: Optional[str] = None) -> 'MultiObjectStore':
         """
@@ -191,6 +589,11 @@ class MultiObjectStore(ObjectStore):
         :return: self
         """
         self.map_prefix_fs[prefix] = fs
+        # longest prefix first, so that the most specific file system wins in _fs
+        self._sorted_prefixes = sorted(
+            [(p, f) for p, f in self.map_prefix_fs.items() if p is not None],
+            key=lambda item: -len(item[0])
+        )
         return self
 
     def put_object(self, path: str, data: bytes) -> None:
@@ -199,11 +602,29 @@ class MultiObjectStore(ObjectStore):
     def get_object(self, path: str) -> bytes:
         return self._fs(path).get_object(path)
 
+    async def aget_object(self, path: str) -> bytes:
+        return await self._fs(path).aget_object(path)
+
     def exists(self, path: str) -> bool:
         return self._fs(path).exists(path)
 
+    def exists_list(self, paths: List[str]) -> List[str]:
+        """
+        Delegates each group of paths to its file system, so that their batched exists_list implementations are used
+        """
+        existing = set()
+        for fs, fs_paths in self._group_by_fs(paths).items():
+            existing.update(fs.exists_list(fs_paths))
+        return [p for p in paths if p in existing]
+
+    async def aexists_list(self, paths: List[str]) -> List[str]:
+        groups = self._group_by_fs(paths)
+        results = await asyncio.gather(*(fs.aexists_list(fs_paths) for fs, fs_paths in groups.items()))
+        existing = {p for fs_existing in results for p in fs_existing}
+        return [p for p in paths if p in existing]
+
     def ls(self, path: str, query: ListQuery=None) -> List[str]:
-        return self._fs(path).ls(path)
+        return self._fs(path).ls(path, query)
 
     def rm(self, path: str, recursive=False) -> None:
         return self._fs(path).rm(path, recursive)
@@ -215,42 +636,103 @@ class MultiObjectStore(ObjectStore):
         return self._fs(p).path_join(p, *paths)
 
     def _fs(self, path: str) -> ObjectStore:
-        fs_list = [fs for prefix, fs in self.map_prefix_fs.items() if prefix is not None and path.startswith(prefix)]
-        if len(fs_list) > 0:
-            return fs_list[0]
-        else:
-            return self.map_prefix_fs[None]
+        for prefix, fs in self._sorted_prefixes:
+            if path.startswith(prefix):
+                return fs
+        return self.map_prefix_fs[None]
+
+    def _group_by_fs(self, paths: List[str]) -> Dict[ObjectStore, List[str]]:
+        paths_per_fs = defaultdict(list)
+        for p in paths:
+            paths_per_fs[self._fs(p)].append(p)
+        return paths_per_fs
+
+
+class _InMemoryWriter(io.BytesIO):
+    """
+    Buffer that hands its content to on_close when closed
+    """
+    def __init__(self, on_close: Callable[[bytes], None]):
+        super().__init__()
+        self._on_close = on_close
+
+    def close(self) -> None:
+        if not self.closed:
+            self._on_close(self.getvalue())
+        super().close()
 
 
 class InMemoryObjectStore(ObjectStore):
-    perPath_data = {}
+    """
+    Paths are "/" separated, like S3 keys
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, concurrency: int = 32):
+        super().__init__(concurrency)
+        self._data = {}
 
     def get_object(self, path: str) -> bytes:
-        return self.perPath_data[path]
+        try:
+            return self._data[path]
+        except KeyError:
+            raise ObjectStoreException(f"No object at path: {path}")
 
     def put_object(self, path: str, data: bytes) -> None:
-        self.perPath_data[path] = data
-        pass
+        self._data[path] = bytes(data)
 
     def ls(self, path: str, query: ListQuery = None) -> List[str]:
-        return self.perPath_data[path] # todo more efficient implementation
+        """
+        Lists the objects and "directories" directly under path. With a query, like S3, lists those starting with
+        path + prefix, or all objects starting with it if the query is recursive
+        """
+        if query is None:
+            prefix = path if path == "" or path.endswith("/") else path + "/"
+            recursive = False
+        else:
+            prefix = path + (query.prefix or "")
+            recursive = bool(query.recursive)
+        folder = prefix[:prefix.rfind("/") + 1]
+        files = set()
+        for k in self._data:
+            if k.startswith(prefix):
+                files.add(k if recursive else folder + k[len(folder):].split("/", 1)[0])
+        return sorted(files)
 
     def rm(self, path: str, recursive=False) -> None:
-        pass
+        if recursive:
+            folder = path.rstrip("/") + "/"
+            for k in [k for k in self._data if k == path or k.startswith(folder)]:
+                del self._data[k]
+        else:
+            self._data.pop(path, None)
 
     def exists(self, path: str) -> bool:
-        pass
+        """
+        Like the other stores, "directories" of existing objects exist too
+        """
+        if path in self._data:
+            return True
+        folder = path.rstrip("/") + "/"
+        return any(k.startswith(folder) for k in self._data)
+
+    def exists_list(self, paths: List[str]) -> List[str]:
+        return [p for p in paths if self.exists(p)]
 
     def open(self, file, mode='r', **kwargs):
-        pass
+        if "r" in mode:
+            fp = io.BytesIO(self.get_object(file))
+        else:
+            fp = _InMemoryWriter(lambda data: self.put_object(file, data))
+        return fp if "b" in mode else io.TextIOWrapper(fp, **kwargs)
 
     def path_join(self, p: str, *paths) -> str:
-        pass
+        return _slash_join(p, *paths)
 
 
 def create_multi_object_store() -> MultiObjectStore:
     return MultiObjectStore()\
-        .add_fs(S3ObjectStore(), "s3://")\
+        .add_fs(S3ObjectStore(), _S3_PREFIX)\
         .add_fs(LocalObjectStore())
 
 
@@ -1,4 +1,4 @@
-from src.fs import S3ObjectStore
+from src.objectstore import S3ObjectStore
 from test.unit_tests import ObjectStoreUnitTests
 import argparse
 
@@ -1,14 +1,25 @@
 import unittest
+from unittest import mock
 
+import asyncio
+import io
+import os
 import shutil
-from src.fs import ObjectStore, LocalObjectStore
-from typing import List
-import random
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from src import objectstore
+from src.objectstore import ObjectStore, LocalObjectStore, S3ObjectStore, MultiObjectStore, S3Query, \
+    InMemoryObjectStore, ObjectStoreException
+from typing import List, Optional, Callable
+import itertools
 
 LOCAL_DISK_TEST_FOLDER = "/tmp/py-simple-s3-fs/tests/"
 
 
 class ObjectStoreUnitTests(unittest.TestCase):
+    # unique payloads, so that reading another path's data can't pass a test by chance
+    _PAYLOAD_IDS = itertools.count()
+
     def setUp(self):
         pass
 
@@ -19,6 +30,10 @@ class ObjectStoreUnitTests(unittest.TestCase):
         store = LocalObjectStore()
         self.run_tests(store, LOCAL_DISK_TEST_FOLDER)
 
+    def test_run_tests_in_memory(self):
+        store = InMemoryObjectStore()
+        self.run_tests(store, "memory/", lambda: store.rm("memory/", recursive=True))
+
     def _reset_state(self):
         if len(LOCAL_DISK_TEST_FOLDER) < 14:
             raise AssertionError(f"Fail safe check, are you sure the local test folder is: {LOCAL_DISK_TEST_FOLDER}. Sanity checking to avoid deleting important folders.")
@@ -29,21 +44,26 @@ class ObjectStoreUnitTests(unittest.TestCase):
         except FileNotFoundError:
             pass  # no need to raise this The folder may not exist and that doesn't matter.
 
-    def run_tests(self, store: ObjectStore, folder: str):
+    def run_tests(self, store: ObjectStore, folder: str, reset_store: Optional[Callable[[], None]] = None):
         """
         We run all tests under this so that we can easily run the same set of tests for any given ObjectStore.
+        :param reset_store: called before each test to clear the store, for stores not on the local disk test folder
         """
         tests = [
             self._test_put_object_and_get_object,
             self._test_open_read,
             self._test_open_write,
             self._test_ls,
+            self._test_ls_query,
             self._test_exists,
             self._test_exists_list,
+            self._test_exists_list_bulk,
             self._test_rm
         ]
         for test in tests:
             self._reset_state()
+            if reset_store is not None:
+                reset_store()
             test(store, folder)
 
     def _test_put_object_and_get_object(self, store: ObjectStore, folder: str):
@@ -91,12 +111,37 @@ class ObjectStoreUnitTests(unittest.TestCase):
         print(store.ls(t2_path))
         self.assertEqual(expected, store.ls(t2_path))
 
+    def _test_ls_query(self, store: ObjectStore, folder: str):
+        for f in ["_lala", "wee.txt", "folder/_lala", "folder/subfolder/_lala", "folderish"]:
+            store.put_object(store.path_join(folder, f), self._make_payload().encode())
+
+        self.assertEqual([store.path_join(folder, "_lala")], store.ls(folder, S3Query(prefix="_")))
+        expected = [store.path_join(folder, f) for f in ["folder", "folderish"]]
+        self.assertEqual(expected, store.ls(folder, S3Query(prefix="fo")))
+
+        t2_path = store.path_join(folder, "folder/")
+        expected = [store.path_join(t2_path, f) for f in ["_lala", "subfolder/_lala"]]
+        self.assertEqual(expected, store.ls(t2_path, S3Query(prefix="", recursive=True)))
+        self.assertEqual(expected[1:], store.ls(t2_path, S3Query(prefix="sub", recursive=True)))
+
+        # the prefix is appended to the path as is, like S3 keys
+        t3_path = store.path_join(folder, "fol")
+        self.assertEqual([store.path_join(folder, "folder"), store.path_join(folder, "folderish")],
+                         store.ls(t3_path, S3Query(prefix="der")))
+        self.assertEqual([store.path_join(folder, "folder/subfolder/_lala")],
+                         store.ls(store.path_join(folder, "folder"), S3Query(prefix="/sub", recursive=True)))
+
     def _test_exists(self, store: ObjectStore, folder: str):
         path = store.path_join(folder, "f1.txt")
         self.assertFalse(store.exists(path))
         store.put_object(path, self._make_payload().encode())
         self.assertTrue(store.exists(path))
 
+        folder_path = store.path_join(folder, "sub")
+        self.assertFalse(store.exists(folder_path))
+        store.put_object(store.path_join(folder_path, "f2.txt"), self._make_payload().encode())
+        self.assertTrue(store.exists(folder_path))
+
     def _test_exists_list(self, store: ObjectStore, folder: str):
         paths = [store.path_join(folder, f) for f in ["f1.txt", "f2.txt"]]
         self.assertEquals([], store.exists_list(paths))
@@ -105,6 +150,13 @@ class ObjectStoreUnitTests(unittest.TestCase):
         store.put_object(paths[1], self._make_payload().encode())
         self.assertEquals(paths, store.exists_list(paths))
 
+    def _test_exists_list_bulk(self, store: ObjectStore, folder: str):
+        paths = [store.path_join(folder, d, f"f{i}.txt") for d in ["", "folder/", "folder/subfolder/"] for i in range(20)]
+        written = paths[::3]
+        for path in written:
+            store.put_object(path, self._make_payload().encode())
+        self.assertEqual(written, store.exists_list(paths))
+
     def _test_rm(self, store: ObjectStore, folder: str):
         data = self._make_payload()
         p1 = store.path_join(folder, "f1.txt")
@@ -128,6 +180,332 @@ class ObjectStoreUnitTests(unittest.TestCase):
             "folder1/folder2/something.gz"
         ]]
 
+    @classmethod
+    def _make_payload(cls):
+        return f"payload_{next(cls._PAYLOAD_IDS)}"
+
+
+class ObjectStoreSubclassUnitTests(unittest.TestCase):
+    def test_exists_list_without_super_init(self):
+        class Store(ObjectStore):
+            def __init__(self):
+                pass
+
+            def exists(self, path: str) -> bool:
+                return path != "missing"
+
+        self.assertEqual(["a", "b"], Store().exists_list(["a", "missing", "b"]))
+
+
+class LocalObjectStoreUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalObjectStore()
+
+    def tearDown(self):
+        shutil.rmtree(LOCAL_DISK_TEST_FOLDER, ignore_errors=True)
+
+    def test_recursive_ls_of_missing_folder_is_empty(self):
+        path = os.path.join(LOCAL_DISK_TEST_FOLDER, "missing")
+        self.assertEqual([], self.store.ls(path, S3Query(recursive=True)))
+
+    def test_recursive_ls_skips_unreadable_folders(self):
+        f1 = os.path.join(LOCAL_DISK_TEST_FOLDER, "f1.txt")
+        f2 = os.path.join(LOCAL_DISK_TEST_FOLDER, "unreadable", "f2.txt")
+        self.store.put_object(f1, b"data")
+        self.store.put_object(f2, b"data")
+        scandir = os.scandir
+
+        def fake_scandir(path):
+            if path.endswith("unreadable"):
+                raise PermissionError(path)
+            return scandir(path)
+
+        with mock.patch("os.scandir", side_effect=fake_scandir):
+            self.assertEqual([f1], self.store.ls(LOCAL_DISK_TEST_FOLDER, S3Query(recursive=True)))
+
+    def test_exists_list_matches_os_path_exists(self):
+        for name in ["f1.txt", "F2.txt", "sub/f3.txt"]:
+            self.store.put_object(os.path.join(LOCAL_DISK_TEST_FOLDER, name), b"data")
+        names = ["f1.txt", "f2.txt", "F2.txt", "missing", ".", "..", "sub", "sub/", "sub/.", "sub/f3.txt", "sub/x"]
+        paths = [os.path.join(LOCAL_DISK_TEST_FOLDER, n) for n in names]
+        self.assertEqual([p for p in paths if os.path.exists(p)], self.store.exists_list(paths))
+
+
+class InMemoryObjectStoreUnitTests(unittest.TestCase):
+    def test_instances_do_not_share_data(self):
+        store, other_store = InMemoryObjectStore(), InMemoryObjectStore()
+        store.put_object("memory/f1.txt", b"data")
+        self.assertTrue(store.exists("memory/f1.txt"))
+        self.assertFalse(other_store.exists("memory/f1.txt"))
+        self.assertEqual([], other_store.ls("memory/"))
+
+    def test_recursive_rm_keeps_siblings(self):
+        store = InMemoryObjectStore()
+        for path in ["d/a", "d/a/x", "d/ab", "d/abc/x"]:
+            store.put_object(path, b"data")
+        store.rm("d/a", recursive=True)
+        self.assertEqual(["d/ab", "d/abc/x"], store.ls("d/", S3Query(recursive=True)))
+        store.rm("d/abc/", recursive=True)
+        self.assertEqual(["d/ab"], store.ls("d/", S3Query(recursive=True)))
+
+    def test_get_object_missing(self):
+        with self.assertRaises(ObjectStoreException):
+            InMemoryObjectStore().get_object("memory/missing")
+
+    def test_ls_query(self):
+        store = InMemoryObjectStore()
+        for path in ["d/a", "d/b", "d/sub/a", "e/a"]:
+            store.put_object(path, b"data")
+        self.assertEqual(["d/a"], store.ls("d/", S3Query(prefix="a")))
+        self.assertEqual(["d/a"], store.ls("d", S3Query(prefix="/a")))
+        self.assertEqual(["d/sub"], store.ls("d/", S3Query(prefix="s")))
+        self.assertEqual(["d/a", "d/b", "d/sub/a"], store.ls("d/", S3Query(recursive=True)))
+
+
+class S3ObjectStoreUnitTests(unittest.TestCase):
+    """
+    Runs against a stubbed S3 client, no requests are sent
+    """
+    def setUp(self):
+        self.store = S3ObjectStore(cache_ttl=0)
+        self.stubber = Stubber(self.store._s3)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_exists_list_lists_common_prefix_once(self):
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'Contents': [{'Key': k} for k in ["d/a", "d/sub/x", "d/z"]], 'IsTruncated': False},
+            {'Bucket': "bucket", 'Prefix': "d/", 'MaxKeys': 1000}
+        )
+        paths = ["s3://bucket/d/" + k for k in ["z", "missing", "sub", "sub/", "a", "su"]]
+        self.assertEqual(
+            ["s3://bucket/d/z", "s3://bucket/d/sub", "s3://bucket/d/sub/", "s3://bucket/d/a"],
+            self.store.exists_list(paths)
+        )
+        self.stubber.assert_no_pending_responses()
+
+    def test_exists_list_falls_back_to_exists_on_large_listing(self):
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'Contents': [{'Key': f"d/{i}"} for i in range(1001)], 'IsTruncated': False}
+        )
+        with mock.patch.object(self.store, "exists", side_effect=lambda p: p.endswith("/0")) as exists:
+            self.assertEqual(["s3://bucket/d/0"], self.store.exists_list(["s3://bucket/d/0", "s3://bucket/d/x"]))
+        self.assertEqual(2, exists.call_count)
+
+    def test_exists_list_without_common_directory_does_not_list(self):
+        # no stubbed response, listing would fail
+        with mock.patch.object(self.store, "exists", side_effect=lambda p: p.endswith("x")) as exists:
+            self.assertEqual(["s3://bucket/a/x"], self.store.exists_list(["s3://bucket/a/x", "s3://bucket/z/y"]))
+            self.assertEqual(["s3://bucket/ax"], self.store.exists_list(["s3://bucket/ax", "s3://bucket/ay"]))
+        self.assertEqual(4, exists.call_count)
+
+    def test_get_object_small_object_is_a_single_request(self):
+        self.stubber.add_response(
+            'get_object',
+            {'Body': self._body(b"data"), 'ContentRange': "bytes 0-3/4", 'ETag': '"e1"'},
+            {'Bucket': "bucket", 'Key': "d/f", 'Range': f"bytes=0-{objectstore._GET_CHUNK_SIZE - 1}"}
+        )
+        self.assertEqual(b"data", self.store.get_object("s3://bucket/d/f"))
+        self.stubber.assert_no_pending_responses()
+
+    def test_get_object_missing(self):
+        self.stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+        with self.assertRaises(FileNotFoundError):
+            self.store.get_object("s3://bucket/missing")
+
+    def test_get_object_empty(self):
+        self.stubber.add_client_error('get_object', service_error_code='InvalidRange', http_status_code=416)
+        self.stubber.add_response('get_object', {'Body': self._body(b"")}, {'Bucket': "bucket", 'Key': "empty"})
+        self.assertEqual(b"", self.store.get_object("s3://bucket/empty"))
+
+    def test_get_object_large_object_is_fetched_in_ranges(self):
+        data = bytes(range(256)) * 4
+
+        def get_object(Bucket, Key, Range, IfMatch=None):
+            start, end = map(int, Range[len("bytes="):].split("-"))
+            self.assertEqual(None if start == 0 else '"e1"', IfMatch)
+            end = min(end, len(data) - 1)
+            return {'Body': self._body(data[start:end + 1]), 'ContentRange': f"bytes {start}-{end}/{len(data)}", 'ETag': '"e1"'}
+
+        with mock.patch.object(objectstore, "_GET_CHUNK_SIZE", 100), \
+                mock.patch.object(self.store._s3, "get_object", side_effect=get_object) as get:
+            self.assertEqual(data, self.store.get_object("s3://bucket/big"))
+        self.assertEqual(11, get.call_count)
+
+    def test_ls_query_is_sorted(self):
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'Contents': [{'Key': "d/a-b"}, {'Key': "d/b"}], 'CommonPrefixes': [{'Prefix': "d/a/"}], 'IsTruncated': False},
+            {'Bucket': "bucket", 'Prefix': "d/", 'Delimiter': "/", 'MaxKeys': 1000}
+        )
+        self.assertEqual(
+            ["s3://bucket/d/a", "s3://bucket/d/a-b", "s3://bucket/d/b"],
+            self.store.ls("s3://bucket/d/", S3Query(prefix=""))
+        )
+
+    def test_aexists_list_runs_on_s3fs_loop(self):
+        async def exists(path):
+            self.assertIs(self.store._s3fs.loop, asyncio.get_running_loop())
+            return path.endswith("1")
+
+        with mock.patch.object(self.store._s3fs, "_exists", side_effect=exists):
+            paths = ["s3://bucket/1", "s3://bucket/2", "s3://bucket/31"]
+            self.assertEqual(["s3://bucket/1", "s3://bucket/31"], asyncio.run(self.store.aexists_list(paths)))
+
+    def test_aexists_list_is_bounded_by_concurrency(self):
+        store = S3ObjectStore(concurrency=2, cache_ttl=0)
+        in_flight, max_in_flight = 0, 0
+
+        async def exists(path):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= 1
+            return True
+
+        with mock.patch.object(store._s3fs, "_exists", side_effect=exists):
+            paths = [f"s3://bucket/{i}" for i in range(10)]
+            self.assertEqual(paths, asyncio.run(store.aexists_list(paths)))
+        self.assertEqual(2, max_in_flight)
+
+    def test_ls_query_appends_prefix_to_path(self):
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'Contents': [{'Key': "dx"}], 'CommonPrefixes': [{'Prefix': "dxy/"}], 'IsTruncated': False},
+            {'Bucket': "bucket", 'Prefix': "dx", 'Delimiter': "/", 'MaxKeys': 1000}
+        )
+        self.assertEqual(["s3://bucket/dx", "s3://bucket/dxy"], self.store.ls("s3://bucket/d", S3Query(prefix="x")))
+
+    def test_split_path(self):
+        self.assertEqual(("bucket", ""), S3ObjectStore._split_path("s3://bucket"))
+        self.assertEqual(("bucket", ""), S3ObjectStore._split_path("s3://bucket/"))
+        self.assertEqual(("bucket", "d/f"), S3ObjectStore._split_path("s3://bucket/d/f"))
+        self.assertEqual(("bucket", "d/"), S3ObjectStore._split_path("s3://bucket/d/"))
+
+    def test_split_path_rejects_non_s3_paths(self):
+        for path in ["/tmp/f", "bucket/f", "s3:/bucket/f"]:
+            with self.assertRaises(ObjectStoreException):
+                S3ObjectStore._split_path(path)
+
     @staticmethod
-    def _make_payload():
-        return "payload_" + str(random.randint(0, 100000))
+    def _body(data: bytes) -> StreamingBody:
+        return StreamingBody(io.BytesIO(data), len(data))
+
+
+class S3ObjectStoreCacheUnitTests(unittest.TestCase):
+    def setUp(self):
+        objectstore._S3_METADATA_CACHE.clear()
+        self.store = S3ObjectStore(cache_ttl=60)
+        self.other_store = S3ObjectStore(cache_ttl=60)
+        patches = [
+            mock.patch.object(self.store._s3fs, "exists", return_value=False),
+            mock.patch.object(self.store._s3fs, "ls", return_value=[]),
+            mock.patch.object(self.store._s3fs, "rm"),
+            mock.patch.object(self.store._s3, "upload_fileobj"),
+        ]
+        self.s3fs_exists, self.s3fs_ls, _, _ = [p.start() for p in patches]
+        for p in patches:
+            self.addCleanup(p.stop)
+        self.addCleanup(objectstore._S3_METADATA_CACHE.clear)
+
+    def test_repeated_calls_are_cached(self):
+        self.assertFalse(self.store.exists("s3://bucket/d/f"))
+        self.assertFalse(self.store.exists("s3://bucket/d/f"))
+        self.assertEqual([], self.store.ls("s3://bucket/d/"))
+        self.assertEqual([], self.store.ls("s3://bucket/d/"))
+        self.assertEqual(1, self.s3fs_exists.call_count)
+        self.assertEqual(1, self.s3fs_ls.call_count)
+
+    def test_cache_disabled(self):
+        store = S3ObjectStore(cache_ttl=0)
+        store.exists("s3://bucket/d/f")
+        store.exists("s3://bucket/d/f")
+        self.assertEqual(2, self.s3fs_exists.call_count)
+
+    @mock.patch.object(S3ObjectStore, "_ls_query", return_value=[])
+    def test_put_object_invalidates_path_and_parents_across_stores(self, ls_query):
+        self.store.exists("s3://bucket/d/f")
+        self.store.exists("s3://bucket/d")
+        self.store.exists("s3://bucket/other")
+        self.store.ls("s3://bucket/d/")
+        self.store.ls("s3://bucket/d/", S3Query(prefix="f", recursive=True))
+        self.s3fs_exists.return_value = True
+        self.s3fs_ls.return_value = ["bucket/d/f"]
+        ls_query.return_value = ["s3://bucket/d/f"]
+
+        self.other_store.put_object("s3://bucket/d/f", b"data")
+        self.assertTrue(self.store.exists("s3://bucket/d/f"))
+        self.assertTrue(self.store.exists("s3://bucket/d"))
+        self.assertFalse(self.store.exists("s3://bucket/other"))
+        self.assertEqual(["s3://bucket/d/f"], self.store.ls("s3://bucket/d/"))
+        self.assertEqual(["s3://bucket/d/f"], self.store.ls("s3://bucket/d/", S3Query(prefix="f", recursive=True)))
+
+    def test_close_of_file_opened_for_writing_invalidates(self):
+        with mock.patch.object(self.store._s3fs, "open", return_value=io.BytesIO()):
+            f = self.store.open("s3://bucket/d/f", "wb")
+            self.assertFalse(self.store.exists("s3://bucket/d/f"))
+            f.write(b"data")
+            self.s3fs_exists.return_value = True
+            f.close()
+        self.assertTrue(self.store.exists("s3://bucket/d/f"))
+
+    def test_recursive_rm_invalidates_children(self):
+        self.s3fs_exists.return_value = True
+        self.store.exists("s3://bucket/d/sub/f")
+        self.s3fs_exists.return_value = False
+        self.other_store.rm("s3://bucket/d", recursive=True)
+        self.assertFalse(self.store.exists("s3://bucket/d/sub/f"))
+
+
+class MultiObjectStoreUnitTests(unittest.TestCase):
+    def test_exists_list_delegates_to_each_fs(self):
+        s3_store = mock.Mock(spec=ObjectStore)
+        s3_store.exists_list.side_effect = lambda paths: paths[1:]
+        local_store = LocalObjectStore()
+        multi = MultiObjectStore().add_fs(s3_store, "s3://").add_fs(local_store)
+
+        path = os.path.join(LOCAL_DISK_TEST_FOLDER, "f1.txt")
+        local_store.put_object(path, b"data")
+        try:
+            paths = ["s3://b/1", path, "s3://b/2", "/missing/f", "s3://b/3"]
+            self.assertEqual([path, "s3://b/2", "s3://b/3"], multi.exists_list(paths))
+            s3_store.exists_list.assert_called_once_with(["s3://b/1", "s3://b/2", "s3://b/3"])
+        finally:
+            shutil.rmtree(LOCAL_DISK_TEST_FOLDER)
+
+    def test_longest_prefix_wins(self):
+        default, s3, bucket = LocalObjectStore(), mock.Mock(spec=ObjectStore), mock.Mock(spec=ObjectStore)
+        multi = MultiObjectStore().add_fs(s3, "s3://").add_fs(default).add_fs(bucket, "s3://bucket/")
+        self.assertIs(bucket, multi._fs("s3://bucket/key"))
+        self.assertIs(s3, multi._fs("s3://other/key"))
+        self.assertIs(s3, multi._fs("s3://bucket"))
+        self.assertIs(default, multi._fs("/tmp/s3://bucket/key"))
+
+    def test_aexists_list_delegates_to_each_fs(self):
+        s3_store = mock.Mock(spec=ObjectStore)
+        s3_store.aexists_list = mock.AsyncMock(side_effect=lambda paths: paths[1:])
+        memory_store = InMemoryObjectStore()
+        memory_store.put_object("memory/f1.txt", b"data")
+        multi = MultiObjectStore().add_fs(s3_store, "s3://").add_fs(memory_store)
+
+        paths = ["s3://b/1", "memory/f1.txt", "s3://b/2", "memory/missing"]
+        self.assertEqual(["memory/f1.txt", "s3://b/2"], asyncio.run(multi.aexists_list(paths)))
+        s3_store.aexists_list.assert_awaited_once_with(["s3://b/1", "s3://b/2"])
+
+    def test_aget_object_dispatches_by_prefix(self):
+        memory_store = InMemoryObjectStore()
+        memory_store.put_object("memory/f1.txt", b"data")
+        multi = MultiObjectStore().add_fs(mock.Mock(spec=ObjectStore), "s3://").add_fs(memory_store)
+        self.assertEqual(b"data", asyncio.run(multi.aget_object("memory/f1.txt")))
+
+    def test_ls_passes_query(self):
+        s3_store = mock.Mock(spec=ObjectStore)
+        multi = MultiObjectStore().add_fs(s3_store, "s3://").add_fs(LocalObjectStore())
+        query = S3Query(prefix="a", recursive=True)
+        multi.ls("s3://bucket/d/", query)
+        s3_store.ls.assert_called_once_with("s3://bucket/d/", query)